@@ -139,12 +139,19 @@ class LXRTEncoder(nn.Module):
         return 768
 
     def forward(self, sents, feats, visual_attention_mask=None):
-        train_features = convert_sents_to_features(
-            sents, self.max_seq_length, self.tokenizer)
-
-        input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long).to(self.device)
-        input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long).to(self.device)
-        segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long).to(self.device)
+        """
+        :param sents: Either a list of strings, or the already tokenized
+            (input_ids, input_mask, segment_ids) tensors of shape (b, max_seq_length).
+        """
+        if isinstance(sents[0], str):
+            train_features = convert_sents_to_features(
+                sents, self.max_seq_length, self.tokenizer)
+
+            input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long).to(self.device)
+            input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long).to(self.device)
+            segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long).to(self.device)
+        else:
+            input_ids, input_mask, segment_ids = (t.to(self.device, non_blocking=True) for t in sents)
 
         # print(feats[0].shape)
         if self.mode == 'lxr':
@@ -52,6 +52,8 @@ def parse_args():
     parser.add_argument("--fast", action='store_const', default=False, const=True)
     parser.add_argument("--tiny", action='store_const', default=False, const=True)
     parser.add_argument("--tqdm", action='store_const', default=False, const=True)
+    parser.add_argument("--logEvery", dest='log_every', type=int, default=100,
+                        help='Print the training loss every N iterations, 0 to never print it.')
 
     # Model Loading
     parser.add_argument('--load', type=str, default=None,
@@ -123,7 +125,11 @@ def parse_args():
                         help='training paradigm for refer expression task')
     # Training configuration
     parser.add_argument("--multiGPU", action='store_const', default=False, const=True)
-    parser.add_argument("--numWorkers", dest='num_workers', default=0)
+    parser.add_argument("--amp", action='store_const', default=False, const=True,
+                        help='Use mixed precision (autocast) on cuda.')
+    parser.add_argument("--compile", action='store_const', default=False, const=True,
+                        help='Compile the model with torch.compile (PyTorch >= 2.2) on cuda.')
+    parser.add_argument("--numWorkers", dest='num_workers', default=0, type=int)
 
     # Parse the arguments.
     args = parser.parse_args()
@@ -14,9 +14,11 @@ from src.param import args
 from src.pretrain.qa_answer_table import load_lxmert_qa
 from src.tasks.gqa_model import GQAModel
 if args.patches:
-    from src.tasks.gqa_data_patches import GQADataset, GQATorchDataset, GQAEvaluator
+    from src.tasks.gqa_data_patches import GQADataset, GQATorchDataset, GQAEvaluator, collate_fn, build_target, \
+        worker_init_fn
 else:
-    from src.tasks.gqa_data import GQADataset, GQATorchDataset, GQAEvaluator
+    from src.tasks.gqa_data import GQADataset, GQATorchDataset, GQAEvaluator, collate_fn, build_target, \
+        worker_init_fn
 
 print(args)
 #dictionary to hold indices to extract attention from based on the cross attn type
@@ -36,7 +38,8 @@ def get_tuple(splits: str, bs:int, shuffle=False, drop_last=False) -> DataTuple:
     data_loader = DataLoader(
         tset, batch_size=bs,
         shuffle=shuffle, num_workers=args.num_workers,
-        drop_last=drop_last, pin_memory=True
+        drop_last=drop_last, pin_memory=True,
+        collate_fn=collate_fn, worker_init_fn=worker_init_fn
     )
 
     return DataTuple(dataset=dset, loader=data_loader, evaluator=evaluator)
@@ -104,7 +107,8 @@ class GQA:
                 self.optim.zero_grad()
 
                 if torch.cuda.is_available():
-                    feats, boxes, target = feats.cuda(), boxes.cuda(), target.cuda()
+                    feats, boxes = feats.cuda(), boxes.cuda()
+                target = build_target(target, dset.num_answers, device)
                 logit, attn_probs = self.model(feats, boxes, sent)
                 assert logit.dim() == target.dim() == 2
                 if args.mce_loss:
@@ -227,6 +231,7 @@ class GQA:
         dset, loader, evaluator = data_tuple
         quesid2ans = {}
         for i, (ques_id, feats, boxes, sent, target) in enumerate(loader):
+            target = build_target(target, dset.num_answers)
             _, label = target.max(1)
             for qid, l in zip(ques_id, label.cpu().numpy()):
                 ans = dset.label2ans[l]
@@ -1,14 +1,12 @@
 # coding=utf-8
 # Copyleft 2019 project LXRT.
 
-import json
-
 import numpy as np
 import torch
 from torch.utils.data import Dataset
 
 from src.param import args
-from src.utils import load_obj_tsv, load_spatial_gqa
+from src.utils import load_obj_tsv, load_spatial_gqa, load_json, load_json_cached, save_json
 
 # Load part of the dataset for fast checking.
 # Notice that here is the number of images instead of the number of data,
@@ -36,7 +34,7 @@ class GQADataset:
         # Loading datasets to data
         self.data = []
         for split in self.splits:
-            self.data.extend(json.load(open("../../data/gqa/%s.json" % split)))
+            self.data.extend(load_json("../../data/gqa/%s.json" % split))
         print("Load %d data from split(s) %s." % (len(self.data), self.name))
 
         # List to dict (for evaluation and others)
@@ -44,10 +42,14 @@ class GQADataset:
             datum['question_id']: datum
             for datum in self.data
         }
+        self.qid2label = {
+            ques_id: datum['label']
+            for ques_id, datum in self.id2datum.items() if 'label' in datum
+        }
 
         # Answers
-        self.ans2label = json.load(open("../../data/gqa/trainval_ans2label.json"))
-        self.label2ans = json.load(open("../../data/gqa/trainval_label2ans.json"))
+        self.ans2label = load_json_cached("../../data/gqa/trainval_ans2label.json")
+        self.label2ans = load_json_cached("../../data/gqa/trainval_label2ans.json")
         assert len(self.ans2label) == len(self.label2ans)
         for ans, label in self.ans2label.items():
             assert self.label2ans[label] == ans
@@ -114,10 +116,8 @@ class GQATorchDataset(Dataset):
             self.imgid2img[img_datum['img_id']] = img_datum
 
         # Only kept the data with loaded image features
-        self.data = []
-        for datum in self.raw_dataset.data:
-            if datum['img_id'] in self.imgid2img:
-                self.data.append(datum)
+        valid_img_ids = frozenset(self.imgid2img)
+        self.data = [datum for datum in self.raw_dataset.data if datum['img_id'] in valid_img_ids]
         print("Use %d data in torch dataset" % (len(self.data)))
         print()
 
@@ -162,22 +162,31 @@ class GQATorchDataset(Dataset):
             return ques_id, feats, boxes, ques
 
 
+# Same loader hooks as gqa_data_patches; the default collate and worker setup are used here.
+collate_fn = None
+worker_init_fn = None
+
+
+def build_target(target, num_answers, device='cpu'):
+    """
+    The targets of this dataset are already dense (b, num_answers) tensors,
+    so they are only moved to `device`.
+    """
+    return target.to(device)
+
+
 class GQAEvaluator:
     def __init__(self, dataset: GQADataset):
         self.dataset = dataset
 
     def evaluate(self, quesid2ans: dict):
-        score = 0.
-        for quesid, ans in quesid2ans.items():
-            datum = self.dataset.id2datum[quesid]
-            label = datum['label']
-            if ans in label:
-                score += label[ans]
-        return score / len(quesid2ans)
+        qid2label = self.dataset.qid2label
+        scores = np.fromiter((qid2label[quesid].get(ans, 0.) for quesid, ans in quesid2ans.items()),
+                             dtype=np.float32, count=len(quesid2ans))
+        return float(scores.sum()) / len(quesid2ans)
 
     def save_json(self, data, file_path):
-        with open(file_path, "w") as f:
-            json.dump(data, f)
+        save_json(data, file_path)
 
     def dump_result(self, quesid2ans: dict, path):
         """
@@ -193,13 +202,12 @@ class GQAEvaluator:
         :param path: The file path to save the json file.
         :return:
         """
-        with open(path, 'w') as f:
-            result = []
-            for ques_id, ans in quesid2ans.items():
-                result.append({
-                    'questionId': ques_id,
-                    'prediction': ans
-                })
-            json.dump(result, f, indent=4, sort_keys=True)
+        result = []
+        for ques_id, ans in quesid2ans.items():
+            result.append({
+                'questionId': ques_id,
+                'prediction': ans
+            })
+        save_json(result, path, indent=True, sort_keys=True)
 
 
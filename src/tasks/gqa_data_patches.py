@@ -1,14 +1,14 @@
 # coding=utf-8
 # Copyleft 2019 project LXRT.
 
-import json
-
+import h5py
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, get_worker_info
+from torch.utils.data.dataloader import default_collate
 
 from src.param import args
-from src.utils import load_obj_tsv, load_patches
+from src.utils import load_obj_tsv, load_patches_index, load_json, load_json_cached, save_json
 
 # Load part of the dataset for fast checking.
 # Notice that here is the number of images instead of the number of data,
@@ -16,6 +16,9 @@ from src.utils import load_obj_tsv, load_patches
 TINY_IMG_NUM = 512
 FAST_IMG_NUM = 5000
 
+# Spatial size of the feature map.
+PATCH_H, PATCH_W = 7, 7
+
 
 class GQADataset:
     """
@@ -36,7 +39,7 @@ class GQADataset:
         # Loading datasets to data
         self.data = []
         for split in self.splits:
-            self.data.extend(json.load(open("data/gqa/%s.json" % split)))
+            self.data.extend(load_json("data/gqa/%s.json" % split))
         print("Load %d data from split(s) %s." % (len(self.data), self.name))
 
         # List to dict (for evaluation and others)
@@ -44,14 +47,27 @@ class GQADataset:
             datum['question_id']: datum
             for datum in self.data
         }
+        self.qid2label = {
+            ques_id: datum['label']
+            for ques_id, datum in self.id2datum.items() if 'label' in datum
+        }
 
         # Answers
-        self.ans2label = json.load(open("data/gqa/trainval_ans2label.json"))
-        self.label2ans = json.load(open("data/gqa/trainval_label2ans.json"))
+        self.ans2label = load_json_cached("data/gqa/trainval_ans2label.json")
+        self.label2ans = load_json_cached("data/gqa/trainval_label2ans.json")
         assert len(self.ans2label) == len(self.label2ans)
         for ans, label in self.ans2label.items():
             assert self.label2ans[label] == ans
 
+        # Convert each label dict to sparse (index, score) tensors once,
+        # so the dense target can be built with a single scatter per sample.
+        for datum in self.data:
+            if 'label' in datum:
+                labels = [(self.ans2label[ans], score) for ans, score in datum['label'].items()
+                          if ans in self.ans2label]
+                datum['_target_idx'] = torch.tensor([l for l, _ in labels], dtype=torch.long)
+                datum['_target_val'] = torch.tensor([score for _, score in labels], dtype=torch.float)
+
     @property
     def num_answers(self):
         return len(self.ans2label)
@@ -73,7 +89,7 @@ class GQABufferLoader():
             path = "data/gqa/train_patches_32x32.hdf5"
         key = "%s_%d" % (path, number)
         if key not in self.key2data:
-            self.key2data[key] = load_patches(
+            self.key2data[key] = load_patches_index(
                 path,
                 dataset='gqa',
                 topk=number
@@ -83,6 +99,21 @@ class GQABufferLoader():
 
 gqa_buffer_loader = GQABufferLoader()
 
+# Open hdf5 patch files of the current process, keyed by path. Each DataLoader
+# worker opens its own handles (h5py handles must not be shared across fork),
+# so features are streamed from disk instead of being held in memory.
+_h5_files = {}
+
+
+def open_patches(path, reopen=False):
+    if reopen or path not in _h5_files:
+        _h5_files[path] = h5py.File(path, 'r')
+    return _h5_files[path]
+
+
+def worker_init_fn(worker_id):
+    open_patches(get_worker_info().dataset.h5_path, reopen=True)
+
 
 """
 Example in obj tsv:
@@ -90,6 +121,9 @@ FIELDNAMES = ["img_id", "img_h", "img_w", "objects_id", "objects_conf",
               "attrs_id", "attrs_conf", "num_boxes", "boxes", "features"]
 """
 class GQATorchDataset(Dataset):
+    # Constant all-ones "boxes" input of length h*w + 1, shared by every sample.
+    _BOXES = np.ones(PATCH_H * PATCH_W + 1, dtype=np.float32)
+
     def __init__(self, dataset: GQADataset):
         super().__init__()
         self.raw_dataset = dataset
@@ -101,25 +135,19 @@ class GQATorchDataset(Dataset):
         else:
             topk = -1
 
-        # Loading detection features to img_data
+        # Only index the image features here; they are read lazily in __getitem__.
         # Since images in train and valid both come from Visual Genome,
-        # buffer the image loading to save memory.
-        img_data = []
+        # buffer the index loading to save memory.
         if 'testdev' in dataset.splits or 'testdev_all' in dataset.splits:     # Always loading all the data in testdev
-            img_data.extend(gqa_buffer_loader.load_data('testdev', -1))
+            self.h5_path, self.imgid2row = gqa_buffer_loader.load_data('testdev', -1)
         elif 'valid' in dataset.splits:
-            img_data.extend(gqa_buffer_loader.load_data('valid', -1))
+            self.h5_path, self.imgid2row = gqa_buffer_loader.load_data('valid', -1)
         else:
-            img_data.extend(gqa_buffer_loader.load_data('train', topk))
-        self.imgid2img = {}
-        for img_datum in img_data:
-            self.imgid2img[img_datum['img_id']] = img_datum
+            self.h5_path, self.imgid2row = gqa_buffer_loader.load_data('train', topk)
 
         # Only kept the data with loaded image features
-        self.data = []
-        for datum in self.raw_dataset.data:
-            if datum['img_id'] in self.imgid2img:
-                self.data.append(datum)
+        valid_img_ids = frozenset(self.imgid2row)
+        self.data = [datum for datum in self.raw_dataset.data if datum['img_id'] in valid_img_ids]
         print("Use %d data in torch dataset" % (len(self.data)))
         print()
 
@@ -132,14 +160,17 @@ class GQATorchDataset(Dataset):
         img_id = datum['img_id']
         ques_id = datum['question_id']
         ques = datum['sent']
-        h,w = 7,7
         # Get image info
-        img_info = self.imgid2img[img_id]
-        obj_num = img_info['num_boxes']
         # boxes = img_info['boxes'].copy()
-        feats = img_info['features'].copy()
+        # the hdf5 read returns a fresh array, so view it instead of copying;
+        # the collate/pin_memory step makes the only copy
+        h5 = open_patches(self.h5_path)
+        feats = h5['data'][self.imgid2row[img_id]]
+        if not feats.flags.c_contiguous:
+            feats = np.ascontiguousarray(feats)
+        feats = torch.from_numpy(feats)
         # assert len(boxes) == len(feats) == obj_num
-        boxes = np.ones(h*w + 1, dtype=np.float32)  # assuming feats of shape [d, h, w]
+        boxes = self._BOXES  # assuming feats of shape [d, h, w]
         # Normalize the boxes (to 0 ~ 1)
         # img_h, img_w = img_info['img_h'], img_info['img_w']
         # boxes = boxes.copy()
@@ -150,32 +181,58 @@ class GQATorchDataset(Dataset):
 
         # Create target
         if 'label' in datum:
-            label = datum['label']
-            target = torch.zeros(self.raw_dataset.num_answers)
-            for ans, score in label.items():
-                if ans in self.raw_dataset.ans2label:
-                    target[self.raw_dataset.ans2label[ans]] = score
-            return ques_id, feats, boxes, ques, target
+            # the dense target is only built on the training device, see `build_target`
+            return ques_id, feats, boxes, ques, (datum['_target_idx'], datum['_target_val'])
         else:
             return ques_id, feats, boxes, ques
 
 
+def collate_fn(batch):
+    """
+    Collate GQATorchDataset samples, padding the sparse targets instead of
+    stacking dense `num_answers`-sized vectors.
+
+    The target of a batch is the pair (target_idx, target_val), both of shape
+    (b, max_labels). Padded entries have index 0 and score 0, so they are no-ops
+    for `build_target`.
+    """
+    if len(batch[0]) == 4:
+        return default_collate(batch)
+    ques_id, feats, boxes, ques = default_collate([sample[:4] for sample in batch])
+    targets = [sample[4] for sample in batch]
+    max_labels = max(max(len(idx) for idx, _ in targets), 1)
+    target_idx = torch.zeros(len(batch), max_labels, dtype=torch.long)
+    target_val = torch.zeros(len(batch), max_labels)
+    for i, (idx, val) in enumerate(targets):
+        target_idx[i, :len(idx)] = idx
+        target_val[i, :len(val)] = val
+    return ques_id, feats, boxes, ques, (target_idx, target_val)
+
+
+def build_target(target, num_answers, device='cpu'):
+    """
+    Build the dense (b, num_answers) target from the padded pair returned by
+    `collate_fn`, directly on `device`.
+    """
+    target_idx, target_val = target
+    target_idx = target_idx.to(device, non_blocking=True)
+    target_val = target_val.to(device, non_blocking=True)
+    dense = torch.zeros(target_idx.size(0), num_answers, device=device)
+    return dense.scatter_add_(1, target_idx, target_val)
+
+
 class GQAEvaluator:
     def __init__(self, dataset: GQADataset):
         self.dataset = dataset
 
     def evaluate(self, quesid2ans: dict):
-        score = 0.
-        for quesid, ans in quesid2ans.items():
-            datum = self.dataset.id2datum[quesid]
-            label = datum['label']
-            if ans in label:
-                score += label[ans]
-        return score / len(quesid2ans)
+        qid2label = self.dataset.qid2label
+        scores = np.fromiter((qid2label[quesid].get(ans, 0.) for quesid, ans in quesid2ans.items()),
+                             dtype=np.float32, count=len(quesid2ans))
+        return float(scores.sum()) / len(quesid2ans)
 
     def save_json(self, data, file_path):
-        with open(file_path, "w") as f:
-            json.dump(data, f)
+        save_json(data, file_path)
 
     def dump_result(self, quesid2ans: dict, path):
         """
@@ -191,13 +248,12 @@ class GQAEvaluator:
         :param path: The file path to save the json file.
         :return:
         """
-        with open(path, 'w') as f:
-            result = []
-            for ques_id, ans in quesid2ans.items():
-                result.append({
-                    'questionId': ques_id,
-                    'prediction': ans
-                })
-            json.dump(result, f, indent=4, sort_keys=True)
+        result = []
+        for ques_id, ans in quesid2ans.items():
+            result.append({
+                'questionId': ques_id,
+                'prediction': ans
+            })
+        save_json(result, path, indent=True, sort_keys=True)
 
 
@@ -3,11 +3,13 @@
 
 import os
 import collections
+import contextlib
 
 import gc
 import torch
 from tqdm import tqdm
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.utils.data.dataloader import DataLoader
 
 from src import eval_utils
@@ -18,16 +20,24 @@ from src.tasks.refcocog_data import RefCOCOgDataset, RefCOCOgTorchDataset, RefCO
 
 print(args)
 DataTuple = collections.namedtuple("DataTuple", 'dataset loader evaluator')
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+# DataLoader accepts `pin_memory_device` from PyTorch 1.13 on
+TORCH_VERSION = tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2])
 
 
 def get_tuple(splits: str, bs:int, shuffle=False, drop_last=False) -> DataTuple:
     dset = RefCOCOgDataset(splits)
     tset = RefCOCOgTorchDataset(dset)
     evaluator = RefCOCOgEvaluator(dset)
+    loader_kwargs = {}
+    if device == 'cuda' and TORCH_VERSION >= (1, 13):
+        loader_kwargs['pin_memory_device'] = device
     data_loader = DataLoader(
         tset, batch_size=bs,
         shuffle=shuffle, num_workers=args.num_workers,
-        drop_last=drop_last, pin_memory=True
+        drop_last=drop_last, pin_memory=True,
+        persistent_workers=args.num_workers > 0,  # do not re-spawn workers every epoch
+        **loader_kwargs
     )
 
     return DataTuple(dataset=dset, loader=data_loader, evaluator=evaluator)
@@ -58,35 +68,55 @@ class RefCOCOg:
                            label2ans=self.train_tuple.dataset.label2ans)
 
         # GPU options
-        if torch.cuda.is_available():
-            self.device = 'cuda'
-        else:
-            self.device = 'cpu'
+        self.device = device
         self.model = self.model.to(self.device)
         if args.multiGPU and self.device == 'cuda':
             self.model.lxrt_encoder.multi_gpu()
 
+        # Compile in place (nn.Module.compile), so attributes and state_dict keys are unchanged.
+        # 'reduce-overhead' replays CUDA graphs, whose outputs are overwritten by the next
+        # step: a new step is marked per iteration and outputs kept across steps are cloned.
+        self.compiled = args.compile and self.device == 'cuda' and hasattr(self.model, 'compile')
+        if self.compiled:
+            self.model.compile(mode='reduce-overhead', fullgraph=False)
+        elif args.compile:
+            print("torch.compile is not used: it needs cuda and PyTorch >= 2.2")
+
+        # Mixed precision: fp16 autocast with loss scaling for training, bf16 autocast for
+        # inference where the GPU supports it (fp16 otherwise, e.g. on V100/T4)
+        self.use_amp = args.amp and self.device == 'cuda'
+        if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+            self.scaler = torch.amp.GradScaler('cuda', enabled=self.use_amp)
+        else:   # PyTorch < 2.3
+            self.scaler = torch.cuda.amp.GradScaler(enabled=self.use_amp)
+        self.predict_dtype = torch.bfloat16 if self.use_amp and torch.cuda.is_bf16_supported() else torch.float16
+
         # Losses and optimizer
         self.bce_loss = nn.BCEWithLogitsLoss()
         self.mce_loss = nn.CrossEntropyLoss(ignore_index=-1)
-        self.l1_loss = nn.L1Loss(reduction='none')
 
         if 'bert' in args.optim:
             batch_per_epoch = len(self.train_tuple.loader)
             t_total = int(batch_per_epoch * args.epochs)
             print("Total Iters: %d" % t_total)
             from src.lxrt.optimization import BertAdam
-            self.optim = BertAdam(list(self.model.parameters()),
+            self.optim = BertAdam(self.model.parameters(),
                                   lr=args.lr,
                                   warmup=0.1,
                                   t_total=t_total)
         else:
-            self.optim = args.optimizer(list(self.model.parameters()), args.lr)
+            self.optim = args.optimizer(self.model.parameters(), args.lr)
 
         self.output = args.output
 
         os.makedirs(self.output, exist_ok=True)
 
+    def autocast(self, dtype):
+        # no autocast context at all without amp, it warns on cpu-only hosts even when disabled
+        if not self.use_amp:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device, dtype=dtype)
+
     def train(self, train_tuple, eval_tuple):
         dset, loader, evaluator = train_tuple
         iter_wrapper = (lambda x: tqdm(x, total=len(loader))) if args.tqdm else (lambda x: x)
@@ -95,43 +125,61 @@ class RefCOCOg:
         for epoch in range(args.epochs):
             # log_str = ''
             sentid2pbox = {}
+            preds = []      # (sent_id, pred_boxes) per iteration, copied to the cpu once per epoch
             for i, (sent_id, feats, boxes, sent, target, is_matched) in iter_wrapper(enumerate(loader)):
 
                 self.model.train()
                 self.optim.zero_grad()
 
-                feats, boxes, target, is_matched = feats.to(self.device), boxes.to(self.device), \
-                                                   target.to(self.device), is_matched.to(self.device)
-
-                logit, attn_probs = self.model(feats, boxes, sent)
-                assert logit.dim() == target.dim() == 2 or logit.dim() == target.dim() == 4
-
-                if self.weakly_supervise:
-                    loss = self.bce_loss(logit, is_matched)
-                else:
-                    loss = self.l1_loss(logit, target)
-                    loss = loss.sum() / logit.shape[0]
-
-                loss.backward()
+                # loader output is pinned, so the copies can overlap with compute
+                feats, boxes = feats.to(self.device, non_blocking=True), boxes.to(self.device, non_blocking=True)
+                target, is_matched = target.to(self.device, non_blocking=True), \
+                                     is_matched.to(self.device, non_blocking=True)
+
+                if self.compiled:
+                    torch.compiler.cudagraph_mark_step_begin()
+                with self.autocast(torch.float16):
+                    logit, attn_probs = self.model(feats, boxes, sent)
+                    assert logit.dim() == target.dim() == 2 or logit.dim() == target.dim() == 4
+
+                    if self.weakly_supervise:
+                        loss = self.bce_loss(logit, is_matched)
+                    else:
+                        loss = F.l1_loss(logit, target, reduction='sum') / logit.shape[0]
+                # score the boxes in fp32, as in predict
+                logit = logit.float()
+
+                # the scaler is a no-op when amp is disabled
+                self.scaler.scale(loss).backward()
+                self.scaler.unscale_(self.optim)
                 nn.utils.clip_grad_norm_(self.model.parameters(), 5.)
-                self.optim.step()
+                self.scaler.step(self.optim)
+                self.scaler.update()
 
                 if self.weakly_supervise:
                     pass
                 else:
-                    miou, accu = eval_utils.trans_vg_eval_val(logit, target)
-                    print('Epoch: {epoch}, Iteration: {iter}, loss: {loss:.6f}, miou: {miou:.4f}, Accuracy: {acc:.4f}'.format(
-                        epoch=epoch,
-                        iter=i,
-                        loss=loss.item(),
-                        miou=miou.detach().mean().cpu().numpy(),
-                        acc=accu
-                    ))
+                    # reading the metrics syncs with the device, so only do it when logging
+                    if args.log_every > 0 and i % args.log_every == 0:
+                        miou, accu = eval_utils.trans_vg_eval_val(logit, target)
+                        print('Epoch: {epoch}, Iteration: {iter}, loss: {loss:.6f}, miou: {miou:.4f}, Accuracy: {acc:.4f}'.format(
+                            epoch=epoch,
+                            iter=i,
+                            loss=loss.item(),
+                            miou=miou.detach().mean().cpu().numpy(),
+                            acc=accu
+                        ))
                     #todo: fix evaluation code for ref expression task
                     pred_boxes = eval_utils.get_pred_boxes(logit)
                 # score, label = logit.max(1)
-                for sid, pbox in zip(sent_id, pred_boxes.cpu().detach().numpy()):
-                    sentid2pbox[sid] = pbox
+                pred_boxes = pred_boxes.detach()
+                if self.compiled:
+                    pred_boxes = pred_boxes.clone()
+                preds.append((sent_id, pred_boxes))
+
+            if preds:
+                sent_ids, pred_boxes = zip(*preds)
+                sentid2pbox = dict(zip(torch.cat(sent_ids).tolist(), torch.cat(pred_boxes).cpu().numpy()))
 
             log_str = "\nEpoch %d: Train %0.2f\n" % (epoch, evaluator.evaluate(sentid2pbox) * 100.)
 
@@ -158,40 +206,61 @@ class RefCOCOg:
     def predict(self, eval_tuple: DataTuple, dump=None):
         self.model.eval()
         dset, loader, evaluator = eval_tuple
+        # attention scores are only serialized along with a result dump
+        dump_attention = dump is not None and self.model.args.output_attention
         sentid2ans = {}
         results = []
+        results_append = results.append
+        # one cpu tensor per batch, converted to lists after the loop
+        attentions = []
+        batch_pred_boxes = []
         for i, datum_tuple in enumerate(loader):
             sent_id, feats, boxes, sent = datum_tuple[:4]   # avoid handling target
-            attention = []
 
             with torch.no_grad():
-                feats, boxes = feats.to(self.device), boxes.to(self.device)
-                logits, attn_probs  = self.model(feats, boxes, sent)
-                # print(attn_probs)
-                if self.model.args.output_attention:
-                    last_layer_att_score = torch.squeeze(attn_probs[1][-1]['attn'][:, :, 0, :])  # batch_size, att_head, target_num_feat, source_num_feat -> use all att head and CLS as target
-                    # print(last_layer_att_score.shape)
-                    last_layer_att_score = last_layer_att_score.cpu().numpy().tolist()
-                else:
-                    last_layer_att_score = []
-
-                pred_boxes = eval_utils.get_pred_boxes(logits)
+                feats, boxes = feats.to(self.device, non_blocking=True), boxes.to(self.device, non_blocking=True)
+                if self.compiled:
+                    torch.compiler.cudagraph_mark_step_begin()
+                with self.autocast(self.predict_dtype):
+                    logits, attn_probs  = self.model(feats, boxes, sent)
+                logits = logits.float()
+                if self.compiled:
+                    logits = logits.clone()
 
                 for sid in sent_id:
                     # ans = dset.label2ans[l]
                     sentid2ans[sid] = logits
-                    results.append(
-                        {
-                            "questionId": sid.tolist(),
-                            "prediction": pred_boxes,
-                            "attention": last_layer_att_score
-                        }
-                    )
+
+                # print(attn_probs)
+                if dump_attention:
+                    last_layer_att_score = torch.squeeze(attn_probs[1][-1]['attn'][:, :, 0, :])  # batch_size, att_head, target_num_feat, source_num_feat -> use all att head and CLS as target
+                    # print(last_layer_att_score.shape)
+                    attentions.append(last_layer_att_score.to('cpu', non_blocking=True))
+                    pred_boxes = eval_utils.get_pred_boxes(logits)
+                    batch_pred_boxes.append(pred_boxes.to('cpu', non_blocking=True))
+
+                    for sid in sent_id:
+                        results_append(
+                            {
+                                "questionId": sid.tolist(),
+                                "prediction": i,    # index of the batch in `batch_pred_boxes`
+                                "attention": i      # index of the batch in `attentions`
+                            }
+                        )
 
             # del logit, attn_probs, datum_tuple
             # gc.collect()
 
-        evaluator.save_json(results, '/data/Grounded-RL2021/lxmert/snap/refcocog/attentions.json')
+        if dump_attention:
+            # wait for the non-blocking copies once, instead of syncing every batch
+            if self.device == 'cuda':
+                torch.cuda.synchronize()
+            attentions = [attention.numpy().tolist() for attention in attentions]
+            batch_pred_boxes = [pred_boxes.numpy().tolist() for pred_boxes in batch_pred_boxes]
+            for result in results:
+                result["prediction"] = batch_pred_boxes[result["prediction"]]
+                result["attention"] = attentions[result["attention"]]
+            evaluator.save_json(results, os.path.join(self.output, 'attentions.json'))
 
         if dump is not None:
             evaluator.dump_result(sentid2ans, dump)
@@ -9,8 +9,11 @@ import torch
 from torch.utils.data import Dataset
 
 from src import eval_utils
+from src.lxrt.entry import convert_sents_to_features
+from src.lxrt.tokenization import BertTokenizer
 from src.param import args
-from src.utils import load_obj_tsv, load_spatial_data
+from src.tasks.refcocog_model import MAX_GQA_LENGTH
+from src.utils import load_obj_tsv, load_spatial_features, save_json
 
 # Load part of the dataset for fast checking.
 # Notice that here is the number of images instead of the number of data,
@@ -76,7 +79,7 @@ class RefCOCOgBufferLoader():
         path = "../../data/refcocog/{}_features.hdf5".format(name)
         key = "%s_%d" % (path, number)
         if key not in self.key2data:
-            self.key2data[key] = load_spatial_data(
+            self.key2data[key] = load_spatial_features(
                 path,
                 topk=number
             )
@@ -108,25 +111,40 @@ class RefCOCOgTorchDataset(Dataset):
         # Loading detection features to img_data
         # Since images in train and valid both come from Visual Genome,
         # buffer the image loading to save memory.
-        img_data = []
+        # The features of all images are kept in one array, indexed by self.imgid2row.
         if 'test' in dataset.splits or 'test' in dataset.splits:     # Always loading all the data in testdev
-            img_data.extend(refcocog_buffer_loader.load_data('test', -1))
+            img_data = refcocog_buffer_loader.load_data('test', -1)
         elif 'valid' in dataset.splits or 'valid' in dataset.splits:     # Always loading all the data in testdev
-            img_data.extend(refcocog_buffer_loader.load_data('valid', -1))
+            img_data = refcocog_buffer_loader.load_data('valid', -1)
         else:
-            img_data.extend(refcocog_buffer_loader.load_data('train', topk))
-        self.imgid2img = {}
-        for img_datum in img_data:
-            self.imgid2img[img_datum['image_id']] = img_datum
+            img_data = refcocog_buffer_loader.load_data('train', topk)
+        self.features, self.imgid2row, self.img_hw = img_data
+        # Constant all-ones "boxes" input of length h*w + 1 (features are [n, d, h, w])
+        self._boxes = np.ones(self.features.shape[2] * self.features.shape[3] + 1, dtype=np.float32)
 
         # Only kept the data with loaded image features
         self.data = []
         for datum in self.raw_dataset.data:
-            if datum['image_id'] in self.imgid2img:
+            if datum['image_id'] in self.imgid2row:
                 self.data.append(datum)
         print("Use %d data in torch dataset" % (len(self.data)))
         print()
 
+        # Tokenize every distinct caption once, instead of in each forward pass.
+        # Uses the same tokenizer and max length as the LXRT encoder of RefCOCOgModel.
+        tokenizer = BertTokenizer.from_pretrained(
+            "bert-base-uncased",
+            do_lower_case=True
+        )
+        sents = list({datum['caption'] for datum in self.data})
+        features = convert_sents_to_features(sents, MAX_GQA_LENGTH, tokenizer)
+        self.sent2features = {
+            sent: (torch.tensor(f.input_ids, dtype=torch.long),
+                   torch.tensor(f.input_mask, dtype=torch.long),
+                   torch.tensor(f.segment_ids, dtype=torch.long))
+            for sent, f in zip(sents, features)
+        }
+
     def __len__(self):
         return len(self.data)
 
@@ -149,19 +167,18 @@ class RefCOCOgTorchDataset(Dataset):
                 sent = other_datum['sent']
 
         # Get image info
-        img_info = self.imgid2img[img_id]
-        obj_num = img_info['num_boxes']
+        row = self.imgid2row[img_id]
         # boxes = img_info['boxes'].copy()
 
-        feats = img_info['features'].copy()
+        feats = self.features[row].copy()
         ##Aisha change:
 
-        boxes = np.ones(feats.shape[1]*feats.shape[2]+1, dtype=np.float32) #assuming feats of shape [d, h, w]
+        boxes = self._boxes
         # assert len(boxes) == len(feats) == obj_num
 
         target_box = datum['refBox']
         # Normalize the boxes (to 0 ~ 1)
-        img_h, img_w = img_info['img_h'], img_info['img_w']
+        img_h, img_w = self.img_hw[row].tolist()    # python ints, so the target stays float32
         target_box = target_box.copy()
         # target_box[:, (0, 2)] /= img_w
         # target_box[:, (1, 3)] /= img_h
@@ -181,6 +198,8 @@ class RefCOCOgTorchDataset(Dataset):
         #             target[self.raw_dataset.ans2label[ans]] = score
         #     return ref_id, feats, target_box, sent, target
         # else:
+        # (input_ids, input_mask, segment_ids) of the sentence
+        sent = self.sent2features[sent]
         return sent_id, feats, boxes, sent, torch.tensor(target_box), is_matched
 
 
@@ -192,7 +211,7 @@ class RefCOCOgEvaluator:
         sid2iou = {}
 
         for sentid, pred_box in sentid2box.items():
-            datum = self.dataset.id2datum[sentid.item()]
+            datum = self.dataset.id2datum[int(sentid)]   # sentid is either an int or a 0-dim tensor
             gt_box = datum['refBox']
             miou, accu = eval_utils.trans_vg_eval_val(torch.as_tensor(pred_box), torch.as_tensor(gt_box))
             sid2iou[sentid] = miou.detach().cpu().numpy()
@@ -205,8 +224,7 @@ class RefCOCOgEvaluator:
         return accu
 
     def save_json(self, data, file_path):
-        with open(file_path, "w") as f:
-            json.dump(data, f)
+        save_json(data, file_path)
 
     def dump_result(self, sentid2box: dict, path):
         """
@@ -46,7 +46,8 @@ class RefCOCOgModel(nn.Module):
 
         :param feat: (b, o, f)
         :param pos:  (b, o, 4)
-        :param sent: (b,) Type -- list of string
+        :param sent: (b,) Type -- list of string, or the tokenized (input_ids, input_mask, segment_ids)
+            tensors of shape (b, MAX_GQA_LENGTH), see RefCOCOgTorchDataset
         :param leng: (b,) Type -- int numpy array
         :return: (b, num_answer) The logit of each answers.
         """
@@ -4,25 +4,69 @@ import base64
 import csv
 import json
 import os
+import pickle
 import sys
 import time
 
 import h5py
 import numpy as np
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 csv.field_size_limit(sys.maxsize)
 FIELDNAMES = ["img_id", "img_h", "img_w", "objects_id", "objects_conf",
               "attrs_id", "attrs_conf", "num_boxes", "boxes", "features"]
 
 
 def load_json(file_path):
+    # orjson parses several times faster than the stdlib json, use it when installed
+    if orjson is not None:
+        with open(file_path, "rb") as f:
+            return orjson.loads(f.read())
     with open(file_path, "r") as f:
         return json.load(f)
 
 
-def save_json(data, file_path):
+def load_json_cached(file_path):
+    """Load a json file through a pickle cache stored next to it (file_path + '.pkl').
+
+    The cache is used when it is newer than the json file, otherwise it is
+    (re)written after parsing the json file.
+    """
+    cache_path = file_path + '.pkl'
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(file_path):
+        with open(cache_path, 'rb') as f:
+            return pickle.load(f)
+
+    data = load_json(file_path)
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)     # atomic, concurrent readers never see a partial file
+    except OSError as e:
+        print("Could not write the json cache %s: %s" % (cache_path, e))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return data
+
+
+def save_json(data, file_path, indent=False, sort_keys=False):
+    """Save data to a json file.
+
+    :param indent: Pretty print the file (2 spaces with orjson, 4 with the stdlib json).
+    :param sort_keys: Sort the keys of the dicts.
+    """
+    if orjson is not None:
+        option = (orjson.OPT_INDENT_2 if indent else 0) | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        with open(file_path, "wb") as f:
+            f.write(orjson.dumps(data, option=option))
+        return
     with open(file_path, "w") as f:
-        json.dump(data, f)
+        json.dump(data, f, indent=4 if indent else None, sort_keys=sort_keys)
 
 
 def load_obj_tsv(fname, topk=None):
@@ -121,6 +165,61 @@ def load_spatial_data(fname, topk=None):
     return data
 
 
+def load_spatial_features(fname, topk=None):
+    """Load ResNet152 features from hdf5 file as one array (struct of arrays).
+
+    Same files as `load_spatial_data`, but instead of one dict per image, the
+    features of all images stay in a single array. When the hdf5 dataset is
+    stored contiguously and uncompressed, the array is a read-only np.memmap of
+    the file, so nothing is read up front and forked DataLoader workers share it.
+    Chunked or compressed datasets cannot be mapped and are loaded fully into RAM.
+
+    :param fname: The path to the hdf5 file.
+    :param topk: Only load features for top K images in the mapping file.
+        Will load all the features if topk is either -1 or None.
+    :return: (features, imgid2row, img_hw), where features[imgid2row[image_id]]
+        are the features of an image and img_hw[imgid2row[image_id]] its (img_h, img_w).
+    """
+    fparts = fname.split('/')
+    fpath = os.path.join(*fparts[:-1])
+    fn = fparts[-1]
+    split = fn.split('_')[0]
+    mapping_fn = os.path.join(fpath, 'img_id2idx_{}.json'.format(split))
+    start_time = time.time()
+    print("Reading %s file" % mapping_fn)
+    img_id2idx_dict = load_json(mapping_fn)
+    print("Start to load ResNet152 features from %s" % fname)
+
+    items = list(img_id2idx_dict.values())
+    if topk is not None and topk >= 0:
+        items = items[:topk]
+
+    h5_path = os.path.join(fpath, '{}_features.hdf5'.format(split))
+    with h5py.File(h5_path, 'r') as h:
+        img_features = h['data']
+        offset = img_features.id.get_offset()
+        if img_features.chunks is None and img_features.compression is None and offset is not None:
+            features = np.memmap(h5_path, dtype=img_features.dtype, mode='r',
+                                 offset=offset, shape=img_features.shape)
+            rows = [item["i"] for item in items]
+        else:
+            # read each image straight into its row, without per-image temporaries
+            features = np.empty((len(items),) + img_features.shape[1:], dtype=img_features.dtype)
+            for row, item in enumerate(items):
+                img_features.read_direct(features, np.s_[item["i"]], np.s_[row])
+            rows = list(range(len(items)))
+
+    imgid2row = {}
+    img_hw = np.zeros((len(features), 2), dtype=np.int64)
+    for item, row in zip(items, rows):
+        imgid2row[item['image_id']] = row
+        img_hw[row] = item['img_h'], item['img_w']
+
+    elapsed_time = time.time() - start_time
+    print("Loaded %d images in file %s in %d seconds." % (len(imgid2row), fname, elapsed_time))
+    return features, imgid2row, img_hw
+
+
 def load_spatial_gqa(fname, topk=None):
     """Load object features from tsv file.
 
@@ -229,3 +328,35 @@ def load_patches(fname, dataset='', topk=None):
     elapsed_time = time.time() - start_time
     print("Loaded %d images in file %s in %d seconds." % (len(data), fname, elapsed_time))
     return data
+
+
+def load_patches_index(fname, dataset='', topk=None):
+    """Load the image id to row index mapping of an image patches hdf5 file.
+
+    Unlike `load_patches`, the features are not read; they can be read lazily
+    with `h5py.File(h5_path, 'r')['data'][row]`.
+
+    :param fname: The path to the hdf5 file.
+    :param topk: Only index the top K images in the mapping file.
+        Will index all the images if topk is either -1 or None.
+    :return: The hdf5 file path and a dict mapping image id to its row index.
+    """
+    assert dataset != ''
+    fparts = fname.split('/')
+    fpath = os.path.join(*fparts[:-1])
+    fn = fparts[-1]
+    split = fn.split('_')[0]
+    mapping_fn = os.path.join(fpath, 'img_id2idx_{dataset}_{split}_32x32.json'.format(dataset=dataset,
+                                                                                      split=split))
+    print("Reading %s file" % mapping_fn)
+    img_id2idx_dict = load_json(mapping_fn)
+
+    imgid2row = {}
+    for img_id, item in img_id2idx_dict.items():
+        imgid2row[img_id] = item["i"]
+        if topk is not None and len(imgid2row) == topk:
+            break
+    print("Indexed %d images in file %s." % (len(imgid2row), fname))
+
+    h5_path = os.path.join(fpath, '{split}_patches_32x32.hdf5'.format(split=split))
+    return h5_path, imgid2row